@@ -1,10 +1,14 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
+import logging
 
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, field_validator
 
 from app.services.dialogue import dialogue_service
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter()
 
 
@@ -68,8 +72,56 @@ async def chat(req: ChatRequest) -> ChatResponse:
         raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         # 记录错误但返回友好的错误信息
-        import logging
-        logging.exception("Chat API error: %s", e)
+        logger.exception("Chat API error: %s", e)
+        raise HTTPException(
+            status_code=500,
+            detail="服务暂时不可用，请稍后重试"
+        )
+
+
+@router.post("/chat/stream")
+async def chat_stream(req: ChatRequest) -> StreamingResponse:
+    """流式对话接口（Server-Sent Events）
+    
+    请求体与 `/chat` 相同。按 OpenAI 流式格式透传增量数据块，
+    结束时发送 `event: result` 事件（内容同 ChatResponse），最后以 `data: [DONE]` 结束。
+    """
+    stream = dialogue_service.generate_reply_stream(
+        user_text=req.userText,
+        session_id=req.sessionId,
+        meta=req.meta,
+    )
+    return StreamingResponse(
+        stream,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post(
+    "/chat/batch",
+    response_model=List[ChatResponse],
+    responses={
+        400: {"model": ErrorResponse, "description": "请求参数错误"},
+        500: {"model": ErrorResponse, "description": "服务器内部错误"},
+    }
+)
+async def chat_batch(reqs: List[ChatRequest]) -> List[ChatResponse]:
+    """批量对话接口（OpenAI Batch API）
+    
+    面向非交互的离线场景（如批量生成测试对话、压测），费用约为实时接口的一半，
+    但需等待 batch 完成（最长 24 小时）。请求体为 ChatRequest 数组，按顺序返回 ChatResponse 数组。
+    各条请求相互独立，不读写会话历史（sessionId 会被忽略）。
+    """
+    try:
+        results = await dialogue_service.generate_replies_batch(
+            [{"userText": req.userText, "meta": req.meta} for req in reqs]
+        )
+        return [ChatResponse(**result) for result in results]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.exception("Chat batch API error: %s", e)
         raise HTTPException(
             status_code=500,
             detail="服务暂时不可用，请稍后重试"
@@ -82,7 +134,7 @@ async def clear_session(session_id: str) -> Dict[str, Any]:
     
     - **session_id**: 要清除的会话ID
     """
-    success = dialogue_service.clear_session(session_id)
+    success = await dialogue_service.clear_session(session_id)
     return {
         "success": success,
         "message": "会话已清除" if success else "会话不存在"
@@ -95,7 +147,7 @@ async def get_session_history(session_id: str) -> Dict[str, Any]:
     
     - **session_id**: 会话ID
     """
-    history = dialogue_service.get_session_history(session_id)
+    history = await dialogue_service.get_session_history(session_id)
     return {
         "sessionId": session_id,
         "history": history,
@@ -1,16 +1,37 @@
 import os
 import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from app.api.chat import router as chat_router
+from app.services.dialogue import dialogue_service, rng
 
 # 记录服务启动时间
 START_TIME = time.time()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    """应用生命周期：启动时创建共享的 LLM HTTP 客户端（及可选的 Redis 客户端）并预热连接，关闭时释放连接池。"""
+    # 每个 worker 独立播种，避免多进程间的 Mock 回复序列相同
+    rng.seed(os.urandom(16))
+    dialogue_service.client = dialogue_service.create_client()
+    dialogue_service.redis = dialogue_service.create_redis()
+    if dialogue_service.api_key:
+        await dialogue_service.warmup()
+    try:
+        yield
+    finally:
+        await dialogue_service.aclose()
+
+
 app = FastAPI(
     title="Digital Human Service",
     description="MetaHuman 数字人后端服务",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # CORS 配置 - 允许前端跨域访问
@@ -34,6 +55,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 响应压缩 - 会话历史等较大的 JSON 响应压缩后传输（starlette>=0.46 的 GZipMiddleware 会跳过 SSE 流式响应）
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 
 @app.get("/health")
 async def health() -> dict:
@@ -1,21 +1,95 @@
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+import asyncio
+import contextlib
+import functools
+import hashlib
 import json
 import logging
 import os
 import random
+import re
+import time
+import weakref
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
 from urllib.parse import urlparse, urlunparse
 
 import httpx
+import orjson
+from cachetools import TTLCache
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 
 logger = logging.getLogger(__name__)
 
 
-# 会话历史存储（生产环境应使用 Redis 等持久化存储）
-session_histories: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+def json_dumps(value: Any, sort_keys: bool = False) -> str:
+  """优先用 orjson 编码；遇到 orjson 不支持的值（如超出 64 位的整数）时回退到标准库"""
+  try:
+    return orjson.dumps(value, option=orjson.OPT_SORT_KEYS if sort_keys else None).decode()
+  except TypeError:
+    return json.dumps(value, ensure_ascii=False, sort_keys=sort_keys)
+
+
+# 以 orjson 编码的请求体需要显式声明 Content-Type（不放在客户端默认头里，以免覆盖 multipart 上传）
+JSON_HEADERS = {"Content-Type": "application/json"}
+BATCH_POLL_MAX_INTERVAL = 60.0  # Batch API 轮询的最大间隔（秒）
+# 上游限流/过载时按指数退避重试，超过次数后交给调用方回退到 Mock
+LLM_RETRY_STATUS_CODES = frozenset({429, 503})
+LLM_MAX_ATTEMPTS = 3
+# 上游 HTTP/2：同一 HTTPS 源的并发请求复用单个连接
+LLM_HTTP2 = True
+
+# 数字人对话大脑的系统提示词
+SYSTEM_PROMPT = (
+  "你是一个活泼、友好的虚拟数字人对话大脑，负责驱动屏幕上的数字人。"
+  "必须使用简体中文、自然口语风格回答用户，语气偏轻松、积极。"
+  "你需要根据用户的话尽量多地使用非 neutral 的 emotion 和非 idle 的 action，"
+  "但在严肃、负面话题时要适当收敛，不要过度夸张。"
+  "请只输出一个 JSON 对象，包含三个字段："
+  "replyText（字符串，给用户的自然语言回答，要友好自然），"
+  "emotion（字符串，取值限定为: neutral, happy, surprised, sad, angry），"
+  "action（字符串，取值限定为: idle, wave, greet, think, nod, shakeHead, dance, speak）。"
+  "emotion 取值建议：正向场景多用 happy；惊喜时用 surprised；负面情绪时用 sad；严肃提醒时用 angry；普通回答用 neutral。"
+  "action 取值建议：招呼告别用 greet/wave；思考用 think/nod；否定用 shakeHead；庆祝用 dance；说话用 speak；静止用 idle。"
+  "严禁输出 JSON 以外的任何文字。"
+)
+
+VALID_EMOTIONS = frozenset({"neutral", "happy", "surprised", "sad", "angry"})
+VALID_ACTIONS = frozenset({"idle", "wave", "greet", "think", "nod", "shakeHead", "dance", "speak"})
+
+# Mock 意图表：按优先级排列的 (关键词, 候选回复)
+MOCK_INTENTS: tuple[tuple[tuple[str, ...], tuple[tuple[str, str, str], ...]], ...] = (
+  (('你好', '您好', 'hello', 'hi', '嗨', '早上好', '下午好', '晚上好'), (
+    ("您好！很高兴见到您，有什么可以帮助您的吗？", "happy", "wave"),
+    ("你好呀！今天心情怎么样？", "happy", "greet"),
+    ("嗨！欢迎来到数字人交互系统！", "happy", "wave"),
+  )),
+  (('你是谁', '介绍', '什么'), (("我是一个数字人助手，可以和您进行对话交流，展示各种表情和动作。", "happy", "greet"),)),
+  (('谢谢', '感谢'), (("不客气！能帮到您我很开心。", "happy", "nod"),)),
+  (('再见', '拜拜', 'bye'), (("再见！期待下次与您交流！", "happy", "wave"),)),
+  (('天气',), (("今天天气看起来不错呢！", "happy", "think"),)),
+  (('跳舞', '舞'), (("好的，让我来给您跳一段舞！", "happy", "dance"),)),
+  (('?', '？', '吗'), (("这是个好问题！让我想想...", "neutral", "think"),)),
+)
+DEFAULT_MOCK_REPLIES = (("我明白了，请继续说。", "neutral", "nod"), ("好的，我在听。", "neutral", "idle"))
+MOCK_REPLY_KEYS = ("replyText", "emotion", "action")
+
+# 会话历史存储：配置 REDIS_URL 时使用 Redis（多 worker 共享），否则回退到进程内存
 MAX_HISTORY_LENGTH = 20  # 最大保留的历史对话轮数
+SESSION_TTL_SECONDS = 3600  # Redis 中会话历史的过期时间
+
+# 模块级随机数生成器（Mock 回复挑选、重试抖动），在 lifespan 中按 worker 重新播种
+rng = random.Random()
+
+# LLM 回复缓存：仅用于显式开启 meta.cache 且无会话的请求，5 分钟过期
+response_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+# 使用定长 deque，追加为 O(1) 且超出上限时自动淘汰最旧的记录
+session_histories: Dict[str, Deque[Dict[str, Any]]] = defaultdict(
+  lambda: deque(maxlen=MAX_HISTORY_LENGTH * 2)
+)
 
 
 class DialogueService:
@@ -24,40 +98,167 @@ class DialogueService:
     self.model = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
     self.base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
     self.provider = os.getenv("LLM_PROVIDER", "openai").lower()
+    # 共享的 HTTP 客户端，由 FastAPI lifespan 创建与关闭，复用连接池避免每次请求重新握手
+    self.client: Optional[httpx.AsyncClient] = None
+    self.redis_url = os.getenv("REDIS_URL")
+    self.redis: Optional[Redis] = None
+    # 未配置 Redis 时，每个会话发往 LLM 的消息列表（以 system 消息开头）缓存在本进程，与历史记录同步追加
+    self._system_msg = {"role": "system", "content": SYSTEM_PROMPT}
     self._session_messages: dict[str, list[dict[str, str]]] = {}
     try:
       self.max_session_messages = int(os.getenv("DIALOGUE_MAX_SESSION_MESSAGES", "10"))
     except ValueError:
       self.max_session_messages = 10
+    # 限制本进程并发的上游 LLM 请求数；同一会话内的请求在本进程内串行执行以保证历史顺序（不跨 worker）
+    try:
+      max_concurrency = int(os.getenv("LLM_MAX_CONCURRENCY", "64"))
+    except ValueError:
+      max_concurrency = 64
+    self._global_sem = asyncio.Semaphore(max(1, max_concurrency))
+    # 弱引用字典：会话锁在没有请求持有时自动回收
+    self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    # 意图表编译为单个正则交替，分组 g<i> 对应 MOCK_INTENTS[i]
+    self._intent_re = re.compile("|".join(
+      f"(?P<g{i}>{'|'.join(re.escape(k) for k in keywords)})"
+      for i, (keywords, _) in enumerate(MOCK_INTENTS)
+    ))
+    # 最后一项为未命中任何意图时的默认回复
+    self._intent_handlers = tuple(replies for _, replies in MOCK_INTENTS) + (DEFAULT_MOCK_REPLIES,)
+    self._default_intent = len(self._intent_handlers) - 1
+    # 只缓存意图下标，回复仍在每次调用时随机挑选
+    self._classify_intent = functools.lru_cache(maxsize=2048)(self._match_intent)
+
+  def create_client(self) -> httpx.AsyncClient:
+    """创建长连接复用的 httpx 客户端（鉴权头统一挂在客户端上）"""
+    headers: Dict[str, str] = {}
+    if self.api_key:
+      headers["Authorization"] = f"Bearer {self.api_key}"
+    # 自定义 transport 时 limits/http2 需配置在 transport 上；retries 仅重试建连失败
+    transport = httpx.AsyncHTTPTransport(
+      retries=3,
+      http2=LLM_HTTP2,
+      limits=httpx.Limits(max_connections=1000, max_keepalive_connections=100),
+    )
+    return httpx.AsyncClient(
+      base_url=self._get_openai_api_base_url(),
+      timeout=httpx.Timeout(30.0, connect=5.0),
+      http2=LLM_HTTP2,
+      transport=transport,
+      headers=headers,
+    )
+
+  async def warmup(self, connections: int = 10) -> None:
+    """启动时请求 /models 预热 TLS 连接，填充 keepalive 连接池
+
+    HTTP/2 下并发请求会复用同一个连接，多发请求无法建立更多连接，因此只发一次。
+    """
+    if not self.api_key:
+      return
+    client = self._get_client()
+    requests = 1 if LLM_HTTP2 else connections
+    results = await asyncio.gather(
+      *[client.get("/models") for _ in range(requests)],
+      return_exceptions=True,
+    )
+    failures = sum(
+      1 for r in results
+      if isinstance(r, BaseException) or not r.is_success
+    )
+    logger.info(
+      "LLM 连接预热完成 requests=%d failures=%d http2=%s",
+      requests,
+      failures,
+      LLM_HTTP2,
+    )
+
+  def create_redis(self) -> Optional[Redis]:
+    """根据 REDIS_URL 创建带连接池的 Redis 客户端，未配置时返回 None"""
+    if not self.redis_url:
+      return None
+    return Redis.from_url(self.redis_url, decode_responses=True)
+
+  async def aclose(self) -> None:
+    """关闭共享的 httpx 客户端与 Redis 客户端，释放连接池"""
+    if self.client is not None:
+      await self.client.aclose()
+      self.client = None
+    if self.redis is not None:
+      await self.redis.aclose()
+      self.redis = None
+
+  def _get_client(self) -> httpx.AsyncClient:
+    # 未经过 lifespan（例如脚本中直接调用）时按需创建
+    if self.client is None:
+      self.client = self.create_client()
+    return self.client
+
+  def _get_redis(self) -> Optional[Redis]:
+    if self.redis is None and self.redis_url:
+      self.redis = self.create_redis()
+    return self.redis
+
+  def _session_lock(self, session_id: Optional[str]) -> contextlib.AbstractAsyncContextManager:
+    if not session_id:
+      return contextlib.nullcontext()
+    lock = self._session_locks.get(session_id)
+    if lock is None:
+      lock = asyncio.Lock()
+      self._session_locks[session_id] = lock
+    return lock
+
+  @staticmethod
+  def _history_key(session_id: str) -> str:
+    return f"sess:{session_id}"
+
+  async def _append_history(self, session_id: str, entry: Dict[str, Any]) -> None:
+    redis = self._get_redis()
+    if redis is None:
+      session_histories[session_id].append(entry)
+      return
+    key = self._history_key(session_id)
+    # Redis 不可用时只丢失本条历史，对话本身照常进行
+    try:
+      async with redis.pipeline(transaction=False) as pipe:
+        pipe.rpush(key, orjson.dumps(entry))
+        pipe.ltrim(key, -MAX_HISTORY_LENGTH * 2, -1)
+        pipe.expire(key, SESSION_TTL_SECONDS)
+        await pipe.execute()
+    except RedisError as exc:
+      logger.warning("写入会话历史失败 session=%s error=%s，本条记录将被跳过", session_id, exc)
+
+  async def _load_history(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    redis = self._get_redis()
+    if redis is None:
+      stored = session_histories.get(session_id, ())
+      start = max(0, len(stored) - limit) if limit else 0
+      return list(islice(stored, start, None))
+    start = -limit if limit else 0
+    try:
+      items = await redis.lrange(self._history_key(session_id), start, -1)
+    except RedisError as exc:
+      logger.warning("读取会话历史失败 session=%s error=%s，将按无历史处理", session_id, exc)
+      return []
+    return [orjson.loads(item) for item in items]
+
+  def _match_intent(self, text: str) -> int:
+    """返回命中的意图下标，未命中时返回默认回复的下标（纯函数，结果可缓存）"""
+    # 单次正则扫描找出所有命中的意图，按意图表顺序取优先级最高者
+    best = self._default_intent
+    for m in self._intent_re.finditer(text.lower()):
+      idx = int(m.lastgroup[1:])
+      if idx < best:
+        best = idx
+        if best == 0:
+          break
+    return best
+
+  def _render_intent(self, intent_idx: int) -> Dict[str, Any]:
+    return dict(zip(MOCK_REPLY_KEYS, rng.choice(self._intent_handlers[intent_idx])))
 
   def _get_smart_mock_reply(self, user_text: str) -> Dict[str, Any]:
     """智能本地 Mock 回复，根据用户输入生成合理的响应"""
-    text_lower = user_text.lower()
-    
-    greetings = ['你好', '您好', 'hello', 'hi', '嗨', '早上好', '下午好', '晚上好']
-    if any(g in text_lower for g in greetings):
-      replies = [
-        ("您好！很高兴见到您，有什么可以帮助您的吗？", "happy", "wave"),
-        ("你好呀！今天心情怎么样？", "happy", "greet"),
-        ("嗨！欢迎来到数字人交互系统！", "happy", "wave"),
-      ]
-      return dict(zip(["replyText", "emotion", "action"], random.choice(replies)))
-    
-    if '你是谁' in user_text or '介绍' in user_text or '什么' in user_text:
-      return {"replyText": "我是一个数字人助手，可以和您进行对话交流，展示各种表情和动作。", "emotion": "happy", "action": "greet"}
-    if '谢谢' in user_text or '感谢' in user_text:
-      return {"replyText": "不客气！能帮到您我很开心。", "emotion": "happy", "action": "nod"}
-    if '再见' in user_text or '拜拜' in user_text or 'bye' in text_lower:
-      return {"replyText": "再见！期待下次与您交流！", "emotion": "happy", "action": "wave"}
-    if '天气' in user_text:
-      return {"replyText": "今天天气看起来不错呢！", "emotion": "happy", "action": "think"}
-    if '跳舞' in user_text or '舞' in user_text:
-      return {"replyText": "好的，让我来给您跳一段舞！", "emotion": "happy", "action": "dance"}
-    if '?' in user_text or '？' in user_text or '吗' in user_text:
-      return {"replyText": "这是个好问题！让我想想...", "emotion": "neutral", "action": "think"}
-    
-    default_replies = [("我明白了，请继续说。", "neutral", "nod"), ("好的，我在听。", "neutral", "idle")]
-    return dict(zip(["replyText", "emotion", "action"], random.choice(default_replies)))
+    return self._render_intent(self._classify_intent(user_text))
 
   async def generate_reply(
     self,
@@ -69,150 +270,336 @@ class DialogueService:
     
     支持会话历史管理和 LLM 调用，当 API Key 未配置时使用智能 Mock 回复。
     """
-    # 记录用户消息到会话历史
-    if session_id:
-      session_histories[session_id].append({
-        "role": "user",
-        "content": user_text,
-        "timestamp": datetime.now().isoformat(),
-      })
-      # 限制历史长度
-      if len(session_histories[session_id]) > MAX_HISTORY_LENGTH * 2:
-        session_histories[session_id] = session_histories[session_id][-MAX_HISTORY_LENGTH * 2:]
+    async with self._session_lock(session_id):
+      # 记录用户消息到会话历史
+      if session_id:
+        await self._append_history(session_id, {
+          "role": "user",
+          "content": user_text,
+          "ts": time.time_ns(),
+        })
 
-    if not self.api_key:
-      logger.info("OPENAI_API_KEY 未配置，使用智能 Mock 回复")
-      result = self._get_smart_mock_reply(user_text)
-      # 记录助手回复到历史
+      if not self.api_key:
+        logger.info("OPENAI_API_KEY 未配置，使用智能 Mock 回复")
+        result = self._get_smart_mock_reply(user_text)
+        # 记录助手回复到历史
+        if session_id:
+          await self._append_history(session_id, {
+            "role": "assistant",
+            "content": result["replyText"],
+            "ts": time.time_ns(),
+          })
+        return result
+
+      cache_key: Optional[bytes] = None
+      if meta and meta.get("cache") and not session_id:
+        cache_key = self._response_cache_key(user_text, meta)
+        cached = response_cache.get(cache_key)
+        if cached is not None:
+          return dict(cached)
+
+      try:
+        messages = await self._build_messages(user_text, session_id, meta)
+        data = await self._call_llm(messages)
+        content = data["choices"][0]["message"]["content"]
+        result = self._parse_llm_content(content, user_text)
+        await self._record_reply(session_id, user_text, result["replyText"])
+        if cache_key is not None:
+          response_cache[cache_key] = dict(result)
+        return result
+      except Exception as exc:
+        return self._fallback_reply(user_text, exc)
+
+  async def generate_reply_stream(
+    self,
+    user_text: str,
+    session_id: Optional[str] = None,
+    meta: Optional[Dict[str, Any]] = None,
+  ) -> AsyncIterator[str]:
+    """流式生成对话回复（SSE）
+
+    透传上游 LLM 的增量数据块；结束时发送 `event: result` 事件，携带解析后的
+    replyText/emotion/action，最后以 `data: [DONE]` 结束。
+    开始输出前失败时回退为 Mock 的 `event: result`；已输出部分数据块后失败则发送
+    `event: error`，避免 Mock 内容与已渲染的增量内容矛盾。
+    """
+    async with self._session_lock(session_id):
       if session_id:
-        session_histories[session_id].append({
-          "role": "assistant",
-          "content": result["replyText"],
-          "timestamp": datetime.now().isoformat(),
+        await self._append_history(session_id, {
+          "role": "user",
+          "content": user_text,
+          "ts": time.time_ns(),
         })
-      return result
-
-    system_prompt = (
-      "你是一个活泼、友好的虚拟数字人对话大脑，负责驱动屏幕上的数字人。"
-      "必须使用简体中文、自然口语风格回答用户，语气偏轻松、积极。"
-      "你需要根据用户的话尽量多地使用非 neutral 的 emotion 和非 idle 的 action，"
-      "但在严肃、负面话题时要适当收敛，不要过度夸张。"
-      "请只输出一个 JSON 对象，包含三个字段："
-      "replyText（字符串，给用户的自然语言回答，要友好自然），"
-      "emotion（字符串，取值限定为: neutral, happy, surprised, sad, angry），"
-      "action（字符串，取值限定为: idle, wave, greet, think, nod, shakeHead, dance, speak）。"
-      "emotion 取值建议：正向场景多用 happy；惊喜时用 surprised；负面情绪时用 sad；严肃提醒时用 angry；普通回答用 neutral。"
-      "action 取值建议：招呼告别用 greet/wave；思考用 think/nod；否定用 shakeHead；庆祝用 dance；说话用 speak；静止用 idle。"
-      "严禁输出 JSON 以外的任何文字。"
+
+      if not self.api_key:
+        logger.info("OPENAI_API_KEY 未配置，使用智能 Mock 回复")
+        result = self._get_smart_mock_reply(user_text)
+        if session_id:
+          await self._append_history(session_id, {
+            "role": "assistant",
+            "content": result["replyText"],
+            "ts": time.time_ns(),
+          })
+      else:
+        parts: list[str] = []
+        forwarded = False
+        try:
+          messages = await self._build_messages(user_text, session_id, meta)
+          # 客户端断开时立即关闭上游流，及时释放并发信号量与上游连接
+          async with contextlib.aclosing(self._stream_llm(messages)) as chunks:
+            async for data in chunks:
+              choices = orjson.loads(data).get("choices") or []
+              if choices:
+                parts.append((choices[0].get("delta") or {}).get("content") or "")
+              forwarded = True
+              yield f"data: {data}\n\n"
+          result = self._parse_llm_content("".join(parts), user_text)
+          await self._record_reply(session_id, user_text, result["replyText"])
+        except Exception as exc:
+          if forwarded:
+            self._log_llm_error(exc, "流式输出中断")
+            yield f"event: error\ndata: {orjson.dumps({'detail': '服务暂时不可用，请稍后重试'}).decode()}\n\n"
+            yield "data: [DONE]\n\n"
+            return
+          result = self._fallback_reply(user_text, exc)
+
+    yield f"event: result\ndata: {orjson.dumps(result).decode()}\n\n"
+    yield "data: [DONE]\n\n"
+
+  async def generate_replies_batch(self, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """通过 OpenAI Batch API 批量生成回复（适用于非交互的离线场景）
+
+    每个 item 包含 userText 与可选的 meta，彼此独立、不读写会话历史。
+    上传 JSONL 输入文件并创建 batch，按指数退避轮询至结束后解析输出文件；
+    未配置 API Key、batch 失败或单条请求出错时回退到智能 Mock 回复。
+    """
+    if not items:
+      return []
+    user_texts = [item["userText"] for item in items]
+    if not self.api_key:
+      logger.info("OPENAI_API_KEY 未配置，批量请求使用智能 Mock 回复")
+      return [self._get_smart_mock_reply(text) for text in user_texts]
+
+    lines = []
+    for idx, item in enumerate(items):
+      messages = await self._build_messages(item["userText"], None, item.get("meta"))
+      lines.append(orjson.dumps({
+        "custom_id": str(idx),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {"model": self.model, "messages": messages, "temperature": 0.7},
+      }))
+
+    try:
+      contents = await self._run_batch(b"\n".join(lines))
+    except Exception as exc:
+      logger.exception("Batch API 调用失败，将使用智能 Mock 回复: %s", exc)
+      return [self._get_smart_mock_reply(text) for text in user_texts]
+
+    results = []
+    for idx, text in enumerate(user_texts):
+      content = contents.get(str(idx))
+      if content is None:
+        logger.warning("Batch 请求 custom_id=%d 无有效输出，将使用智能 Mock 回复", idx)
+        results.append(self._get_smart_mock_reply(text))
+      else:
+        results.append(self._parse_llm_content(content, text))
+    return results
+
+  async def _run_batch(self, jsonl: bytes) -> Dict[str, str]:
+    """执行一次完整的 Batch API 流程，返回 custom_id -> 模型输出内容"""
+    client = self._get_client()
+
+    resp = await client.post(
+      "/files",
+      data={"purpose": "batch"},
+      files={"file": ("chat_batch.jsonl", jsonl, "application/jsonl")},
     )
+    resp.raise_for_status()
+    file_id = orjson.loads(resp.content)["id"]
+
+    resp = await client.post(
+      "/batches",
+      content=orjson.dumps({
+        "input_file_id": file_id,
+        "endpoint": "/v1/chat/completions",
+        "completion_window": "24h",
+      }),
+      headers=JSON_HEADERS,
+    )
+    resp.raise_for_status()
+    batch = orjson.loads(resp.content)
+    logger.info("Batch 已创建 id=%s", batch["id"])
 
-    history_messages: list[dict[str, str]] = []
-    if session_id:
-      history_messages = self._get_session_messages(session_id)
+    delay = 1.0
+    while batch["status"] not in ("completed", "failed", "expired", "cancelled"):
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, BATCH_POLL_MAX_INTERVAL)
+      resp = await client.get(f"/batches/{batch['id']}")
+      resp.raise_for_status()
+      batch = orjson.loads(resp.content)
 
-    messages: list[dict[str, str]] = [
-      {"role": "system", "content": system_prompt},
-    ]
+    if batch["status"] != "completed" or not batch.get("output_file_id"):
+      raise RuntimeError(f"batch {batch['id']} 结束状态为 {batch['status']}")
 
-    # 添加会话历史
-    if history_messages:
-      messages.extend(history_messages)
-    elif session_id and session_id in session_histories:
-      history = session_histories[session_id][-10:]
-      for msg in history:
-        if msg["role"] in ("user", "assistant"):
-          messages.append({"role": msg["role"], "content": msg["content"]})
+    resp = await client.get(f"/files/{batch['output_file_id']}/content")
+    resp.raise_for_status()
 
-    messages.append({"role": "user", "content": user_text})
+    contents: Dict[str, str] = {}
+    for line in resp.content.splitlines():
+      if not line.strip():
+        continue
+      record = orjson.loads(line)
+      response = record.get("response") or {}
+      if record.get("error") or response.get("status_code") != 200:
+        logger.warning("Batch 请求失败 custom_id=%s error=%s", record.get("custom_id"), record.get("error"))
+        continue
+      try:
+        contents[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+      except (KeyError, IndexError, TypeError):
+        logger.warning("Batch 输出格式异常 custom_id=%s", record.get("custom_id"))
+    return contents
+
+  async def _build_messages(
+    self,
+    user_text: str,
+    session_id: Optional[str],
+    meta: Optional[Dict[str, Any]],
+  ) -> list[dict[str, str]]:
+    # 会话消息列表以 system 消息开头、只追加不重建；本轮用户消息只加入本次请求的副本，
+    # 成功回复后才随助手回复一起写入会话消息列表，失败/超时不会在列表中残留
+    if session_id:
+      context = await self._get_session_messages(session_id)
+    else:
+      context = [self._system_msg]
+    messages = [*context, {"role": "user", "content": user_text}]
 
     if meta:
+      # 附加上下文只对本轮有效
       messages.append(
         {
           "role": "system",
-          "content": f"附加上下文信息（可选）：{json.dumps(meta, ensure_ascii=False)}",
+          "content": f"附加上下文信息（可选）：{json_dumps(meta)}",
         }
       )
+    return messages
 
+  def _response_cache_key(self, user_text: str, meta: Dict[str, Any]) -> bytes:
+    # meta 会作为附加上下文发给 LLM，因此与模型、用户输入一起参与缓存键
+    raw = json_dumps([self.model, user_text, meta], sort_keys=True)
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+  def _parse_llm_content(self, content: str, user_text: str) -> Dict[str, Any]:
     try:
-      data = await self._call_llm(messages)
-      content = data["choices"][0]["message"]["content"]
+      parsed = orjson.loads(content)
+    except orjson.JSONDecodeError:
+      parsed = None
+    # 合法 JSON 但不是对象（如数字、数组、字符串）时与非法 JSON 同样处理
+    if not isinstance(parsed, dict):
+      logger.warning("LLM 返回内容不是 JSON 对象，将内容作为 replyText 使用: %s", content)
+      return {
+        "replyText": content,
+        "emotion": "neutral",
+        "action": "idle",
+      }
 
-      try:
-        parsed = json.loads(content)
-      except json.JSONDecodeError:
-        logger.warning("LLM 返回内容不是合法 JSON，将内容作为 replyText 使用: %s", content)
-        return {
-          "replyText": content,
-          "emotion": "neutral",
-          "action": "idle",
-        }
+    reply_text = str(parsed.get("replyText", "")).strip() or f"你刚才说：{user_text}"
+    emotion = str(parsed.get("emotion", "neutral")).strip() or "neutral"
+    action = str(parsed.get("action", "idle")).strip() or "idle"
 
-      reply_text = str(parsed.get("replyText", "")).strip() or f"你刚才说：{user_text}"
-      emotion = str(parsed.get("emotion", "neutral")).strip() or "neutral"
-      action = str(parsed.get("action", "idle")).strip() or "idle"
+    if emotion not in VALID_EMOTIONS:
+      emotion = "neutral"
+    if action not in VALID_ACTIONS:
+      action = "idle"
 
-      if emotion not in {"neutral", "happy", "surprised", "sad", "angry"}:
-        emotion = "neutral"
-      if action not in {"idle", "wave", "greet", "think", "nod", "shakeHead", "dance", "speak"}:
-        action = "idle"
+    return {
+      "replyText": reply_text,
+      "emotion": emotion,
+      "action": action,
+    }
 
-      # 记录消息到会话历史
-      if session_id:
-        session_histories[session_id].append({
-          "role": "assistant",
-          "content": reply_text,
-          "timestamp": datetime.now().isoformat(),
-        })
-        self._append_session_messages(
-          session_id,
-          [
-            {"role": "user", "content": user_text},
-            {"role": "assistant", "content": reply_text},
-          ],
-        )
+  async def _record_reply(self, session_id: Optional[str], user_text: str, reply_text: str) -> None:
+    # 记录消息到会话历史
+    if not session_id:
+      return
+    await self._append_history(session_id, {
+      "role": "assistant",
+      "content": reply_text,
+      "ts": time.time_ns(),
+    })
+    self._append_session_messages(
+      session_id,
+      [
+        {"role": "user", "content": user_text},
+        {"role": "assistant", "content": reply_text},
+      ],
+    )
 
-      return {
-        "replyText": reply_text,
-        "emotion": emotion,
-        "action": action,
-      }
-    except httpx.TimeoutException:
+  def _fallback_reply(self, user_text: str, exc: Exception) -> Dict[str, Any]:
+    """记录 LLM 调用失败原因并回退到智能 Mock 回复"""
+    self._log_llm_error(exc, "将使用智能 Mock 回复")
+    return self._get_smart_mock_reply(user_text)
+
+  def _log_llm_error(self, exc: Exception, outcome: str) -> None:
+    if isinstance(exc, httpx.TimeoutException):
       logger.warning(
-        "LLM 请求超时 url=%s，将使用智能 Mock 回复",
+        "LLM 请求超时 url=%s，%s",
         self._get_openai_chat_completions_url(),
+        outcome,
       )
-      return self._get_smart_mock_reply(user_text)
-    except httpx.HTTPStatusError as exc:
+    elif isinstance(exc, httpx.HTTPStatusError):
       body_preview = (exc.response.text or "")[:500]
       logger.error(
-        "LLM 请求失败 status=%s url=%s body=%s，将使用智能 Mock 回复",
+        "LLM 请求失败 status=%s url=%s body=%s，%s",
         exc.response.status_code,
         str(exc.request.url),
         body_preview,
+        outcome,
       )
-      return self._get_smart_mock_reply(user_text)
-    except httpx.RequestError as exc:
+    elif isinstance(exc, httpx.RequestError):
       req_url = str(exc.request.url) if exc.request else self._get_openai_chat_completions_url()
       logger.error(
-        "LLM 请求异常 url=%s error=%s，将使用智能 Mock 回复",
+        "LLM 请求异常 url=%s error=%s，%s",
         req_url,
         exc,
+        outcome,
       )
-      return self._get_smart_mock_reply(user_text)
-    except Exception as exc:
-      logger.exception("调用 LLM 失败，将使用智能 Mock 回复: %s", exc)
-      return self._get_smart_mock_reply(user_text)
+    else:
+      logger.exception("调用 LLM 失败，%s: %s", outcome, exc)
 
-  def clear_session(self, session_id: str) -> bool:
+  async def clear_session(self, session_id: str) -> bool:
     """清除指定会话的历史记录"""
+    self._session_messages.pop(session_id, None)
+    redis = self._get_redis()
+    if redis is not None:
+      try:
+        return bool(await redis.delete(self._history_key(session_id)))
+      except RedisError as exc:
+        logger.warning("清除会话历史失败 session=%s error=%s", session_id, exc)
+        return False
     if session_id in session_histories:
       del session_histories[session_id]
       return True
     return False
 
-  def get_session_history(self, session_id: str) -> List[Dict[str, str]]:
+  async def get_session_history(self, session_id: str) -> List[Dict[str, str]]:
     """获取指定会话的历史记录"""
-    return session_histories.get(session_id, [])
+    # 历史中只存纳秒整数时间戳，返回给客户端时再格式化为 ISO 字符串
+    return [
+      {
+        "role": entry["role"],
+        "content": entry["content"],
+        "timestamp": self._format_timestamp(entry),
+      }
+      for entry in await self._load_history(session_id)
+    ]
+
+  @staticmethod
+  def _format_timestamp(entry: Dict[str, Any]) -> str:
+    if "ts" in entry:
+      return datetime.fromtimestamp(entry["ts"] / 1e9).isoformat()
+    # 兼容 Redis 中升级前写入的旧记录
+    return entry.get("timestamp", "")
 
   def _get_openai_chat_completions_url(self) -> str:
     base_url = (self.base_url or "").strip()
@@ -244,6 +631,10 @@ class DialogueService:
 
     return urlunparse(parsed._replace(path=final_path))
 
+  def _get_openai_api_base_url(self) -> str:
+    url = self._get_openai_chat_completions_url()
+    return url[: -len("/chat/completions")]
+
   async def _call_llm(self, messages: list[dict[str, str]]) -> Dict[str, Any]:
     provider = (self.provider or "openai").lower()
     logger.debug("Calling LLM provider=%s model=%s messages=%d", provider, self.model, len(messages))
@@ -251,39 +642,101 @@ class DialogueService:
     if provider != "openai":
       logger.warning("LLM_PROVIDER=%s 未实现，暂时使用 openai 作为回退", provider)
 
-    url = self._get_openai_chat_completions_url()
-    headers = {
-      "Authorization": f"Bearer {self.api_key}",
-      "Content-Type": "application/json",
-    }
     payload = {
       "model": self.model,
       "messages": messages,
       "temperature": 0.7,
     }
 
-    async with httpx.AsyncClient(timeout=20.0) as client:
-      resp = await client.post(url, headers=headers, json=payload)
+    # 使用 orjson 直接编码为 bytes，避免 httpx 内部的标准库 json 编码
+    body = orjson.dumps(payload)
+    for attempt in range(LLM_MAX_ATTEMPTS):
+      async with self._global_sem:
+        resp = await self._get_client().post("/chat/completions", content=body, headers=JSON_HEADERS)
+      if resp.status_code not in LLM_RETRY_STATUS_CODES or attempt == LLM_MAX_ATTEMPTS - 1:
+        break
+      await self._retry_backoff(attempt, resp.status_code)
     resp.raise_for_status()
-    return resp.json()
+    return orjson.loads(resp.content)
 
-  def _get_session_messages(self, session_id: str) -> list[dict[str, str]]:
-    return self._session_messages.get(session_id, [])
+  async def _stream_llm(self, messages: list[dict[str, str]]) -> AsyncIterator[str]:
+    """以 stream=True 调用 LLM，逐个产出上游 SSE 的 data 负载（不含 [DONE]）"""
+    logger.debug("Streaming LLM model=%s messages=%d", self.model, len(messages))
+    payload = {
+      "model": self.model,
+      "messages": messages,
+      "temperature": 0.7,
+      "stream": True,
+    }
+
+    body = orjson.dumps(payload)
+    for attempt in range(LLM_MAX_ATTEMPTS):
+      async with self._global_sem:
+        async with self._get_client().stream(
+          "POST", "/chat/completions", content=body, headers=JSON_HEADERS
+        ) as resp:
+          # 限流/过载只可能在开始输出前发生，此时重试不会产生重复的数据块
+          retry = resp.status_code in LLM_RETRY_STATUS_CODES and attempt < LLM_MAX_ATTEMPTS - 1
+          if not retry:
+            if resp.is_error:
+              await resp.aread()
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+              if not line.startswith("data:"):
+                continue
+              data = line[len("data:"):].strip()
+              if data == "[DONE]":
+                break
+              if data:
+                yield data
+            return
+      await self._retry_backoff(attempt, resp.status_code)
+
+  async def _retry_backoff(self, attempt: int, status_code: int) -> None:
+    delay = min(2 ** attempt, 8) + rng.uniform(0, 0.25)
+    logger.warning(
+      "LLM 返回 status=%s，%.2fs 后重试（第 %d/%d 次）",
+      status_code,
+      delay,
+      attempt + 1,
+      LLM_MAX_ATTEMPTS - 1,
+    )
+    await asyncio.sleep(delay)
+
+  async def _get_session_messages(self, session_id: str) -> list[dict[str, str]]:
+    # 配置 Redis 时每轮都从 Redis 重建上下文：其他 worker 处理的轮次与清除操作都能立即生效，
+    # 且不在本进程留下不会过期的缓存；未配置时复用本进程内只追加的消息列表
+    use_cache = self._get_redis() is None
+    messages = self._session_messages.get(session_id) if use_cache else None
+    if messages is None:
+      history = await self._load_history(session_id)
+      # 只保留得到助手回复的用户消息：LLM 失败/超时的轮次在历史中只有用户消息，不应作为上下文重放；
+      # 末尾本轮刚记录的用户消息也因此被排除，由调用方单独追加
+      context: list[dict[str, str]] = []
+      for idx, msg in enumerate(history):
+        answered = idx + 1 < len(history) and history[idx + 1]["role"] == "assistant"
+        if msg["role"] == "assistant" or (msg["role"] == "user" and answered):
+          context.append({"role": msg["role"], "content": msg["content"]})
+      messages = [self._system_msg, *context[-self.max_session_messages:]]
+      if use_cache:
+        self._session_messages[session_id] = messages
+    return messages
 
   def _append_session_messages(
     self,
     session_id: str,
     new_messages: list[dict[str, str]],
   ) -> None:
-    if not session_id:
+    if not session_id or self._get_redis() is not None:
       return
-    history = self._session_messages.get(session_id, [])
+    history = self._session_messages.setdefault(session_id, [self._system_msg])
     history.extend(new_messages)
     truncated = False
-    if len(history) > self.max_session_messages:
-      history = history[-self.max_session_messages :]
+    # 原地裁剪，保留开头的 system 消息与最近 max_session_messages 条对话
+    overflow = len(history) - 1 - self.max_session_messages
+    if overflow > 0:
+      del history[1 : 1 + overflow]
       truncated = True
-    self._session_messages[session_id] = history
     logger.debug(
       "Session %s history size=%d%s",
       session_id,